@@ -1,16 +1,48 @@
+import asyncio
+import functools
+import hashlib
 import os
-from fastapi import FastAPI, HTTPException
+import threading
+from collections import OrderedDict
+from typing import Callable
+import orjson
+from fastapi import FastAPI, HTTPException, Request, Response
 from fastapi.responses import StreamingResponse
+from fastapi.routing import APIRoute
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from app.models import CharacterRequest
 from app.services.pdf_service import PdfService
+from app.services.pdf_stream import iter_pdf
 import time
 
+class OrjsonRequest(Request):
+    """
+    Request that decodes its JSON body with orjson instead of the standard json module.
+    """
+    async def json(self):
+        if not hasattr(self, "_json"):
+            self._json = orjson.loads(await self.body())
+        return self._json
+
+class OrjsonRoute(APIRoute):
+    """
+    Route class that hands orjson-decoded bodies to Pydantic validation.
+    """
+    def get_route_handler(self) -> Callable:
+        original_route_handler = super().get_route_handler()
+
+        async def orjson_route_handler(request: Request) -> Response:
+            return await original_route_handler(OrjsonRequest(request.scope, request.receive))
+
+        return orjson_route_handler
+
 app = FastAPI(
     title="Elysium PDF Service",
     description="Microservice for VtM Character Generator: Elysium.",
     version="1.0.0"
 )
+app.router.route_class = OrjsonRoute
 
 # --- CORS CONFIGURATION ---
 # This is crucial for allowing the browser to communicate directly with this service.
@@ -24,13 +56,58 @@ app.add_middleware(
     ],
     allow_credentials=True,
   
-    allow_methods=["*"],
-    allow_headers=["*"],
+    # Only what the client actually uses, explicit lists avoid reflecting arbitrary request headers.
+    allow_methods=["GET", "POST", "OPTIONS"],
+    allow_headers=["content-type"],
 )
 
+# --- COMPRESSION ---
+# The filled sheet contains compressible streams, gzip cuts download time for the browser.
+# GZipMiddleware compresses on the event loop, so the lowest level is used:
+# it keeps most of the size win at a fraction of the CPU cost of the default (9).
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=1)
+
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 TEMPLATE_PATH = os.path.join(BASE_DIR, "assets", "fillable_v20.pdf")
 
+# Single shared instance, the template is loaded once when the app starts.
+PDF_SERVICE = PdfService(TEMPLATE_PATH)
+
+# --- RESPONSE CACHE ---
+# Identical characters (retries, shared examples) produce the same PDF,
+# so finished files are kept in a small in-process LRU cache.
+# Each sheet is ~2MB, which keeps the cache size modest.
+RESPONSE_CACHE_SIZE = 32
+_response_cache = OrderedDict()
+_response_cache_lock = threading.Lock()
+
+def _cache_key(character: CharacterRequest) -> bytes:
+    """
+    Hashes the validated character payload.
+    Key order is kept as sent, because it decides tie order for disciplines and backgrounds.
+    """
+    return hashlib.blake2b(character.model_dump_json().encode(), digest_size=16).digest()
+
+def _cache_get(key: bytes):
+    """
+    Returns the cached PDF bytes for the key, or None on a miss.
+    """
+    with _response_cache_lock:
+        pdf_bytes = _response_cache.get(key)
+        if pdf_bytes is not None:
+            _response_cache.move_to_end(key)
+        return pdf_bytes
+
+def _cache_put(key: bytes, pdf_bytes: bytes) -> None:
+    """
+    Stores a rendered PDF, evicting the least recently used entry when full.
+    """
+    with _response_cache_lock:
+        _response_cache[key] = pdf_bytes
+        _response_cache.move_to_end(key)
+        if len(_response_cache) > RESPONSE_CACHE_SIZE:
+            _response_cache.popitem(last=False)
+
 @app.get("/")
 def read_root():
     """
@@ -41,26 +118,16 @@ def read_root():
 @app.post("/generate-pdf", response_class=StreamingResponse)
 async def generate_pdf(character: CharacterRequest):
     """
-    Generates a filled PDF and streams it directly to the client.
-    Using chunked transfer encoding to improve Time-To-First-Byte (TTFB).
+    Generates a filled PDF and sends it to the client.
+    Cached sheets are returned in a single body. New sheets are streamed while qpdf
+    is still writing them, so the first bytes do not wait for the full render.
     """
     start_time = time.time()
     try:
         print(f"[LOG] Generation started for character: {character.name}")
         
-        pdf_service = PdfService(TEMPLATE_PATH)
-        char_data = character.model_dump()
-        
-        pdf_stream = pdf_service.generate_character_stream(char_data)
-        
-        # This prevents the server from needing to buffer the entire file before sending response headers
-        def iterfile():
-            pdf_stream.seek(0)
-            while True:
-                chunk = pdf_stream.read(4096)  # Read in 4KB chunks
-                if not chunk:
-                    break
-                yield chunk
+        cache_key = _cache_key(character)
+        pdf_bytes = _cache_get(cache_key)
 
         # Safe filename creation
         safe_name = character.name.replace(" ", "_") if character.name else "Character"
@@ -68,21 +135,40 @@ async def generate_pdf(character: CharacterRequest):
 
         headers = {
             "Content-Disposition": f"attachment; filename={filename}",
-            "X-Process-Time": str(time.time() - start_time) # Custom header for debugging latency
+            "X-Cache": "HIT" if pdf_bytes is not None else "MISS"
         }
-        
-        print(f"[LOG] Stream ready in {time.time() - start_time:.4f}s. Sending response...")
+
+        if pdf_bytes is not None:
+            headers["X-Process-Time"] = str(time.time() - start_time) # Custom header for debugging latency
+            print(f"[LOG] PDF served from cache in {time.time() - start_time:.4f}s.")
+            return Response(
+                content=pdf_bytes,
+                media_type="application/pdf",
+                headers=headers
+            )
+
+        # PDF work is CPU-bound and synchronous, run it off the event loop
+        # so other requests are not blocked while this sheet is rendered.
+        # Filling happens before the response starts, so its errors still map to HTTP errors below.
+        pdf = await asyncio.to_thread(PDF_SERVICE.fill_character_pdf, character)
+
+        async def stream_and_cache():
+            chunks = []
+            async for chunk in iter_pdf(functools.partial(PDF_SERVICE.save_pdf, pdf)):
+                chunks.append(chunk)
+                yield chunk
+            # Only complete files are cached.
+            _cache_put(cache_key, b"".join(chunks))
+
+        headers["X-Process-Time"] = str(time.time() - start_time) # Time until the stream starts
+        print(f"[LOG] Fields filled in {time.time() - start_time:.4f}s. Streaming response...")
 
         return StreamingResponse(
-            iterfile(), 
+            stream_and_cache(),
             media_type="application/pdf",
             headers=headers
         )
 
-    except FileNotFoundError as e:
-        print(f"[ERROR] Template missing: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Configuration Error: PDF Template not found.")
-        
     except Exception as e:
         print(f"[ERROR] Critical failure: {str(e)}")
         raise HTTPException(
@@ -1,7 +1,133 @@
+import functools
+import heapq
 import io
 import os
-from pypdf import PdfReader, PdfWriter
-from pypdf.generic import NameObject
+import pikepdf
+from app.models import CharacterRequest
+
+# Checkbox states shared by every dot field. Names are immutable,
+# so a single instance of each can be reused across all requests.
+_YES = pikepdf.Name.Yes
+_OFF = pikepdf.Name.Off
+
+@functools.lru_cache(maxsize=512)
+def _pretty(name: str) -> str:
+    """
+    Turns a trait id into a display label (e.g. "animal_ken" -> "Animal Ken").
+    The same names repeat across requests, so results are cached.
+    """
+    return name.title().replace("_", " ")
+
+# --- FIELD ORDER ---
+# The PDF uses specific start IDs for each attribute block.
+# Order: Strength(1), Dexterity(9), Stamina(17), Charisma(25), etc.
+ATTR_ORDER = [
+    "strength", "dexterity", "stamina", 
+    "charisma", "manipulation", "appearance", 
+    "perception", "intelligence", "wits"
+]
+
+# Alertness starts at ID 73.
+# Order must match the PDF column flow: Talents -> Skills -> Knowledges
+ABILITY_ORDER = [
+    # Talents
+    "alertness", "athletics", "awareness", "brawl", "empathy", 
+    "expression", "intimidation", "leadership", "streetwise", "subterfuge",
+    # Skills
+    "animal_ken", "crafts", "drive", "etiquette", "firearms", 
+    "larceny", "melee", "performance", "stealth", "survival",
+    # Knowledges
+    "academics", "computer", "finance", "investigation", "law", 
+    "medicine", "occult", "politics", "science", "technology"
+]
+
+# There is only 6 slots for disciplines and backgrounds.
+MAIN_SLOTS = 6
+
+# Virtues start at ID 409 and use a visual block of 5.
+VIRTUE_ORDER = ["conscience", "self_control", "courage"]
+
+def _build_dot_keys(start_index: int, count: int, block_size: int = 8) -> list:
+    """
+    Builds the dot field names for `count` consecutive trait blocks.
+    Each entry is a list of `block_size` keys, e.g. ["dot1", ..., "dot8"].
+    """
+    return [
+        [f"dot{start_index + i * block_size + j}" for j in range(block_size)]
+        for i in range(count)
+    ]
+
+def _build_suffix_keys(start_index: int, count: int, block_size: int = 8) -> list:
+    """
+    Builds the suffix field names (e.g. "dot8a") for `count` consecutive trait blocks.
+    """
+    return [f"dot{start_index + i * block_size + block_size - 1}a" for i in range(count)]
+
+def _build_tracker_keys(prefix: str, max_slots: int = 10) -> list:
+    """
+    Builds linear tracker field names: {prefix}1, {prefix}2, ... (e.g., willdot1, hdot1)
+    """
+    return [f"{prefix}{i}" for i in range(1, max_slots + 1)]
+
+def _build_rating_table(keys: list, suffix_key: str = None) -> tuple:
+    """
+    Builds, for one trait block, the fields to switch on at every rating.
+    Row N holds the keys that are /Yes at rating N, so filling a trait is a single lookup.
+    The last row also covers any higher rating.
+    """
+    table = [tuple(keys[:rating]) for rating in range(len(keys) + 1)]
+    if suffix_key is not None:
+        # If value is 9+, the 8th dot gets a special suffix field (e.g., dot8a)
+        # I dont know why it is like this, i mapped the pdf and this was the result.
+        table.append(tuple(keys) + (suffix_key,))
+    return tuple(table)
+
+# Field names never change, so they are formatted once at import time.
+ATTR_DOT_KEYS = _build_dot_keys(1, len(ATTR_ORDER))
+ATTR_SUFFIX_KEYS = _build_suffix_keys(1, len(ATTR_ORDER))
+ABILITY_DOT_KEYS = _build_dot_keys(73, len(ABILITY_ORDER))
+ABILITY_SUFFIX_KEYS = _build_suffix_keys(73, len(ABILITY_ORDER))
+DISC_DOT_KEYS = _build_dot_keys(313, MAIN_SLOTS)
+DISC_SUFFIX_KEYS = _build_suffix_keys(313, MAIN_SLOTS)
+BACK_DOT_KEYS = _build_dot_keys(361, MAIN_SLOTS)
+BACK_SUFFIX_KEYS = _build_suffix_keys(361, MAIN_SLOTS)
+VIRTUE_DOT_KEYS = _build_dot_keys(409, len(VIRTUE_ORDER), block_size=5)
+HUMANITY_KEYS = _build_tracker_keys("hdot")
+WILLPOWER_KEYS = _build_tracker_keys("willdot")
+
+# The template is fixed, so the /Yes fields for every possible rating are known up front.
+ATTR_RATING_KEYS = [_build_rating_table(k, s) for k, s in zip(ATTR_DOT_KEYS, ATTR_SUFFIX_KEYS)]
+ABILITY_RATING_KEYS = [_build_rating_table(k, s) for k, s in zip(ABILITY_DOT_KEYS, ABILITY_SUFFIX_KEYS)]
+DISC_RATING_KEYS = [_build_rating_table(k, s) for k, s in zip(DISC_DOT_KEYS, DISC_SUFFIX_KEYS)]
+BACK_RATING_KEYS = [_build_rating_table(k, s) for k, s in zip(BACK_DOT_KEYS, BACK_SUFFIX_KEYS)]
+VIRTUE_RATING_KEYS = [_build_rating_table(k) for k in VIRTUE_DOT_KEYS]
+HUMANITY_RATING_KEYS = _build_rating_table(HUMANITY_KEYS)
+WILLPOWER_RATING_KEYS = _build_rating_table(WILLPOWER_KEYS)
+
+# Every checkbox the service controls. Each request starts from all of them
+# set to /Off in a dict of the final size, then only /Yes values are written.
+CHECKBOX_FIELD_NAMES = tuple(
+    key
+    for dot_keys, suffix_keys in (
+        (ATTR_DOT_KEYS, ATTR_SUFFIX_KEYS),
+        (ABILITY_DOT_KEYS, ABILITY_SUFFIX_KEYS),
+        (DISC_DOT_KEYS, DISC_SUFFIX_KEYS),
+        (BACK_DOT_KEYS, BACK_SUFFIX_KEYS),
+    )
+    for block, suffix_key in zip(dot_keys, suffix_keys)
+    for key in (*block, suffix_key)
+) + tuple(key for block in VIRTUE_DOT_KEYS for key in block) + tuple(HUMANITY_KEYS) + tuple(WILLPOWER_KEYS)
+
+def _split_main_overflow(traits: dict) -> tuple:
+    """
+    Splits traits into the highest rated MAIN_SLOTS entries and the rest.
+    Both lists are ordered by rating, highest first, ties keep their input order.
+    """
+    main = heapq.nlargest(MAIN_SLOTS, traits.items(), key=lambda x: x[1])
+    main_names = {name for name, _ in main}
+    overflow = [(name, val) for name, val in traits.items() if name not in main_names]
+    overflow.sort(key=lambda x: x[1], reverse=True)
+    return main, overflow
 
 class PdfService:
     """
@@ -12,95 +138,115 @@ class PdfService:
     def __init__(self, template_path: str):
         self.template_path = template_path
 
-    def _calculate_dots(self, start_index: int, value: int, block_size: int = 8) -> dict:
+        # The template is a deploy-time artifact, so it is validated once here
+        # and the service fails fast at startup instead of on every request.
+        if not os.path.exists(self.template_path):
+            raise FileNotFoundError(f"Template not found at: {self.template_path}")
+
+        # The template never changes at runtime, so we read it once.
+        # Each request opens its own pikepdf document from these bytes,
+        # qpdf parses lazily so this is cheap and needs no locking.
+        with open(template_path, "rb") as template_file:
+            self._template_bytes = template_file.read()
+
+        # Field positions are the same in every copy of the template, so they are indexed once.
+        with pikepdf.Pdf.open(io.BytesIO(self._template_bytes)) as template:
+            self._field_index, self._checkbox_names = self._index_fields(template)
+
+    def _index_fields(self, pdf: pikepdf.Pdf) -> tuple:
+        """
+        Maps each field name (/T) to its position in the /AcroForm /Fields array,
+        and collects the names of the checkbox fields.
+        The V20 sheet uses merged field/widget annotations, so /T and /FT sit on the widget itself.
+        """
+        index = {}
+        checkbox_names = set()
+        for position, field in enumerate(pdf.Root.AcroForm.Fields):
+            if "/T" not in field:
+                continue
+            name = str(field.T)
+            index[name] = position
+            if field.get("/FT") == "/Btn":
+                checkbox_names.add(name)
+        return index, frozenset(checkbox_names)
+
+    def _activate(self, rating_keys: tuple, val: int, out: dict) -> None:
+        """
+        Sets the fields of the given rating to /Yes, clamping the rating to the table.
+        """
+        val = min(max(val, 0), len(rating_keys) - 1)
+        for key in rating_keys[val]:
+            out[key] = _YES
+
+    def _calculate_dots(self, rating_keys: tuple, value: int, out: dict) -> None:
         """
         Calculates the visual 'dots' for attributes, abilities, and disciplines.
         
         Args:
-            start_index (int): The starting field ID for the trait.
+            rating_keys (tuple): The precomputed rating table of the trait block.
             value (int): The character's rating in the trait (1-10).
-            block_size (int): The number of dots in a visual block (default 8).
-            
-        Returns:
-            dict: A dictionary of field names and their activation status (/Yes or /Off).
+            out (dict): The form fields dict, pre-filled with /Off.
+                Only the active dots are set to /Yes.
         """
-        dot_data = {}
-        
         try:
             val = int(value)
         except (ValueError, TypeError):
             val = 0
 
+        self._activate(rating_keys, val, out)
 
-        normal_limit = min(val, block_size)
-        
-        for i in range(block_size):
-            key = f"dot{start_index + i}"
-            dot_data[key] = NameObject("/Yes") if i < normal_limit else NameObject("/Off")
-            
-        # If value is 9+, the 8th dot gets a special suffix field (e.g., dot8a)
-        # I dont know why it is like this, i mapped the pdf and this was the result.
-        end_of_block_id = start_index + block_size - 1
-        suffix_key = f"dot{end_of_block_id}a"
-        
-        # Activate suffix only if value exceeds the standard block size
-        dot_data[suffix_key] = NameObject("/Yes") if val > block_size else NameObject("/Off")
-        
-        return dot_data
-
-    def _calculate_virtues(self, start_index: int, value: int) -> dict:
+    def _calculate_virtues(self, rating_keys: tuple, value: int, out: dict) -> None:
         """
         Calculates dots for Virtues.
         Virtues use a visual block of 5.
+        Sets the active dots to /Yes in `out`, which is pre-filled with /Off.
         """
-        dot_data = {}
         try:
             val = int(value)
         except (ValueError, TypeError):
             val = 1 # Virtues start at 1 and capped at 5
-        val = min(val, 5)
 
-        for i in range(5):
-            key = f"dot{start_index + i}"
-            dot_data[key] = NameObject("/Yes") if i < val else NameObject("/Off")
-        
-        return dot_data
+        self._activate(rating_keys, val, out)
 
-    def _calculate_tracker(self, prefix: str, value: int, max_slots: int = 10) -> dict:
+    def _calculate_tracker(self, rating_keys: tuple, value: int, out: dict) -> None:
         """
         Calculates simple linear trackers like Willpower and Humanity.
-        Field keys format: {prefix}1, {prefix}2, ... (e.g., willdot1, hdot1)
+        Sets the active dots to /Yes in `out`, which is pre-filled with /Off.
         """
-        dot_data = {}
         try:
             val = int(value)
         except (ValueError, TypeError):
             val = 0
 
-        for i in range(1, max_slots + 1):
-            key = f"{prefix}{i}"
-            dot_data[key] = NameObject("/Yes") if i <= val else NameObject("/Off")
-        
-        return dot_data
+        self._activate(rating_keys, val, out)
+
+    def save_pdf(self, pdf: pikepdf.Pdf, stream) -> None:
+        """
+        Serializes a document returned by fill_character_pdf and closes it.
+        A plain (non-linearized) save only calls write() and tell() on the stream,
+        which lets the output be streamed while qpdf is still producing it.
+        """
+        try:
+            pdf.save(stream)
+        finally:
+            pdf.close()
 
-    def generate_character_stream(self, char_data: dict) -> io.BytesIO:
+    def fill_character_pdf(self, character: CharacterRequest) -> pikepdf.Pdf:
         """
-        Generates a filled PDF character sheet in-memory.
+        Opens a fresh copy of the template and fills its form fields, without serializing it.
+        The result must be passed to save_pdf, which also closes it.
         
         Args:
-            char_data (dict): Dictionary containing character properties.
+            character (CharacterRequest): The validated character, read through its attributes.
             
         Returns:
-            io.BytesIO: An in-memory binary stream of the filled PDF.
+            pikepdf.Pdf: The filled document, ready to be saved.
         """
-        if not os.path.exists(self.template_path):
-            raise FileNotFoundError(f"Template not found at: {self.template_path}")
+        pdf = pikepdf.Pdf.open(io.BytesIO(self._template_bytes))
 
-        reader = PdfReader(self.template_path)
-        writer = PdfWriter()
-        writer.append(reader)
-
-        form_fields = {}
+        # Starting from every checkbox at /Off means the dict never resizes
+        # and the helpers below only need to write the /Yes values.
+        form_fields = dict.fromkeys(CHECKBOX_FIELD_NAMES, _OFF)
 
         # --- TEXT FIELDS MAPPING ---
         # Maps incoming JSON keys to PDF AcroForm field names.
@@ -109,17 +255,8 @@ class PdfService:
         # There is only 6 slots for disciplines and backgrounds.
         # We use other section for the overflowing disciplines and backgrounds.
 
-        disciplines = char_data.get("disciplines", {})
-        sorted_discs = sorted(disciplines.items(), key=lambda x: x[1], reverse=True)
-        
-        backgrounds = char_data.get("backgrounds", {})
-        sorted_backs = sorted(backgrounds.items(), key=lambda x: x[1], reverse=True)
-
-        main_disciplines = sorted_discs[:6]
-        overflow_disciplines = sorted_discs[6:]
-
-        main_backgrounds = sorted_backs[:6]
-        overflow_backgrounds = sorted_backs[6:]
+        main_disciplines, overflow_disciplines = _split_main_overflow(character.disciplines)
+        main_backgrounds, overflow_backgrounds = _split_main_overflow(character.backgrounds)
 
         # Prepare lines for the 'Other' section (misc fields)
         other_lines = []
@@ -128,24 +265,23 @@ class PdfService:
         if overflow_disciplines:
             other_lines.append("--- Additional Disciplines ---")
             for name, val in overflow_disciplines:
-                other_lines.append(f"{name.title().replace('_', ' ')}: {val}")
+                other_lines.append(f"{_pretty(name)}: {val}")
 
         if overflow_backgrounds:
             other_lines.append("--- Additional Backgrounds ---")
             for name, val in overflow_backgrounds:
-                other_lines.append(f"{name.title().replace('_', ' ')}: {val}")
+                other_lines.append(f"{_pretty(name)}: {val}")
 
-        merits = char_data.get("merits", [])
-        if merits:
+        # A null cost is shown as 0 pts.
+        if character.merits:
             other_lines.append("--- Merits ---")
-            for merit in merits:
-                other_lines.append(f"{merit.get('name', 'Unknown')}: {merit.get('cost', 0)} pts")
+            for merit in character.merits:
+                other_lines.append(f"{merit.name}: {merit.cost or 0} pts")
 
-        flaws = char_data.get("flaws", [])
-        if flaws:
+        if character.flaws:
             other_lines.append("--- Flaws ---")
-            for flaw in flaws:
-                other_lines.append(f"{flaw.get('name', 'Unknown')}: {flaw.get('cost', 0)} pts")
+            for flaw in character.flaws:
+                other_lines.append(f"{flaw.name}: {flaw.cost or 0} pts")
 
         # Map the lines to specific PDF fields (misc1, misc2... misc13)
         for i, line in enumerate(other_lines):
@@ -153,19 +289,21 @@ class PdfService:
                 form_fields[f"misc{i+1}"] = line
 
         # --- TEXT MAPPING ---
+        # Missing or null values are written as empty strings, never as the text "None".
         text_mapping = {
-            "name": char_data.get("name", ""),
-            "player": char_data.get("player", ""),
-            "chronicle": char_data.get("chronicle", ""),
-            "nature": char_data.get("nature", {}).get("name", "") if isinstance(char_data.get("nature"), dict) else str(char_data.get("nature", "")),
-            "demeanor": char_data.get("demeanor", {}).get("name", "") if isinstance(char_data.get("demeanor"), dict) else str(char_data.get("demeanor", "")),
-            "concept": char_data.get("concept", {}).get("name", "") if isinstance(char_data.get("concept"), dict) else str(char_data.get("concept", "")),
-            "Clan": char_data.get("clan", {}).get("name", "") if isinstance(char_data.get("clan"), dict) else str(char_data.get("clan", "")),
-            "gen": str(char_data.get("generation", "")),
-            "sire": char_data.get("sire", ""),
-            "ppt": str(char_data.get("bloodPointsPerTurn", "")),
-            "weakness": char_data.get("clan", {}).get("weakness", "") if isinstance(char_data.get("clan"), dict) else "",
-            "experience": f"{char_data.get('spentExperience', 0)}/{char_data.get('totalExperience', 0)}",
+            "name": character.name,
+            "player": character.player or "",
+            "chronicle": character.chronicle or "",
+            "nature": character.nature.name if character.nature else "",
+            "demeanor": character.demeanor.name if character.demeanor else "",
+            "concept": character.concept.name if character.concept else "",
+            "Clan": character.clan.name if character.clan else "",
+            "gen": str(character.generation),
+            "sire": character.sire or "",
+            "ppt": str(character.bloodPointsPerTurn),
+            # ReferenceData has no weakness field yet, so this stays empty until the backend sends one.
+            "weakness": getattr(character.clan, "weakness", "") or "",
+            "experience": f"{character.spentExperience}/{character.totalExperience}",
             
             # Intentionally left empty, new title is in misc1 now.
             # Original misctitle area is bugged.
@@ -175,85 +313,60 @@ class PdfService:
 
 
         # --- ATTRIBUTES (Block Size: 8) ---
-        # The PDF uses specific start IDs for each attribute block.
-        # Order: Strength(1), Dexterity(9), Stamina(17), Charisma(25), etc.
-        attr_order = [
-            "strength", "dexterity", "stamina", 
-            "charisma", "manipulation", "appearance", 
-            "perception", "intelligence", "wits"
-        ]
-        
-        attributes = char_data.get("attributes", {})
-        for i, attr_name in enumerate(attr_order):
+        attributes = character.attributes
+        for i, attr_name in enumerate(ATTR_ORDER):
             val = attributes.get(attr_name, 1)
-            start_id = 1 + (i * 8)
-            form_fields.update(self._calculate_dots(start_id, val))
+            self._calculate_dots(ATTR_RATING_KEYS[i], val, form_fields)
 
         # --- ABILITIES (Block Size: 8) ---
-        # Alertness starts at ID 73.
-        # Order must match the PDF column flow: Talents -> Skills -> Knowledges
-        ability_order = [
-            # Talents
-            "alertness", "athletics", "awareness", "brawl", "empathy", 
-            "expression", "intimidation", "leadership", "streetwise", "subterfuge",
-            # Skills
-            "animal_ken", "crafts", "drive", "etiquette", "firearms", 
-            "larceny", "melee", "performance", "stealth", "survival",
-            # Knowledges
-            "academics", "computer", "finance", "investigation", "law", 
-            "medicine", "occult", "politics", "science", "technology"
-        ]
-        
-        abilities = char_data.get("abilities", {})
-        for i, abil_name in enumerate(ability_order):
+        abilities = character.abilities
+        for i, abil_name in enumerate(ABILITY_ORDER):
             val = abilities.get(abil_name, 0)
-            start_id = 73 + (i * 8)
-            form_fields.update(self._calculate_dots(start_id, val))
+            self._calculate_dots(ABILITY_RATING_KEYS[i], val, form_fields)
 
        # --- 4. DISCIPLINES (Main Slots) ---
         # Only the first 6 disciplines are mapped to the visual dots.
         for i, (name, val) in enumerate(main_disciplines):
-            form_fields[f"disciplines{i+1}"] = name.title().replace("_", " ")
-            start_id = 313 + (i * 8)
-            form_fields.update(self._calculate_dots(start_id, val))
+            form_fields[f"disciplines{i+1}"] = _pretty(name)
+            self._calculate_dots(DISC_RATING_KEYS[i], val, form_fields)
 
         # --- 5. BACKGROUNDS (Main Slots) ---
         # Only the first 6 backgrounds are mapped to the visual dots.
         for i, (name, val) in enumerate(main_backgrounds):
-            form_fields[f"back{i+1}"] = name.title().replace("_", " ")
-            start_id = 361 + (i * 8)
-            form_fields.update(self._calculate_dots(start_id, val))
+            form_fields[f"back{i+1}"] = _pretty(name)
+            self._calculate_dots(BACK_RATING_KEYS[i], val, form_fields)
 
         # --- VIRTUES (Block Size: 5) ---
-        # Start ID: 409. Order: Conscience, Self-Control, Courage.
-        virtues = char_data.get("virtues", {})
-        
-        # Conscience (ID 409)
-        form_fields.update(self._calculate_virtues(409, virtues.get("conscience", 1)))
-        # Self-Control (ID 414)
-        form_fields.update(self._calculate_virtues(414, virtues.get("self_control", 1)))
-        # Courage (ID 419)
-        form_fields.update(self._calculate_virtues(419, virtues.get("courage", 1)))
+        # Start ID: 409. Order: Conscience(409), Self-Control(414), Courage(419).
+        virtues = character.virtues
+        for i, virtue_name in enumerate(VIRTUE_ORDER):
+            self._calculate_virtues(VIRTUE_RATING_KEYS[i], virtues.get(virtue_name, 1), form_fields)
 
         # --- TRACKERS ---
         # Humanity (hdot1 - hdot10)
-        form_fields.update(self._calculate_tracker("hdot", char_data.get("humanity", 7)))
+        self._calculate_tracker(HUMANITY_RATING_KEYS, character.humanity, form_fields)
         # Willpower (willdot1 - willdot10)
-        form_fields.update(self._calculate_tracker("willdot", char_data.get("willpower", 6)))
-
-        # --- WRITE & STREAM ---
-        # Update fields in the PDF page
-        writer.update_page_form_field_values(
-            writer.pages[0], 
-            form_fields,
-            auto_regenerate=False
-        )
-
-        # Create an in-memory byte stream
-        output_stream = io.BytesIO()
-        writer.write(output_stream)
-        
-        # Reset pointer to the beginning so it can be read
-        output_stream.seek(0) 
-        
-        return output_stream
\ No newline at end of file
+        self._calculate_tracker(WILLPOWER_RATING_KEYS, character.willpower, form_fields)
+
+        # --- WRITE FIELDS ---
+        # Values are set directly on the field objects through the precomputed index.
+        # Checkboxes only need /V and /AS, their appearance states already exist in the template.
+        # Fields missing from the template are skipped.
+        fields = pdf.Root.AcroForm.Fields
+        for name, value in form_fields.items():
+            position = self._field_index.get(name)
+            if position is None:
+                continue
+            field = fields[position]
+            if name in self._checkbox_names:
+                field.V = value
+                field.AS = value
+            else:
+                field.V = pikepdf.String(value)
+
+        # Text fields have no appearance streams in the template, qpdf builds them here
+        # and clears /NeedAppearances again afterwards.
+        pdf.Root.AcroForm.NeedAppearances = True
+        pdf.generate_appearance_streams()
+
+        return pdf
@@ -0,0 +1,67 @@
+import asyncio
+import io
+from typing import AsyncIterator, Callable
+import anyio
+import anyio.from_thread
+import anyio.to_thread
+from anyio.streams.memory import MemoryObjectSendStream
+
+class PipeWriter:
+    """
+    File-like sink for pikepdf's Pdf.save() that forwards the output to an async consumer.
+    A plain (non-linearized) save only needs write() and tell(),
+    so the bytes can be handed over as soon as they are produced.
+    Must be used from a worker thread started by anyio.
+    """
+
+    def __init__(self, send_stream: MemoryObjectSendStream, chunk_size: int = 65536):
+        self._send_stream = send_stream
+        self._chunk_size = chunk_size
+        self._buffer = bytearray()
+        self._position = 0
+
+    def write(self, data: bytes) -> int:
+        # qpdf emits many tiny writes, they are batched into chunks before crossing threads.
+        self._buffer += data
+        self._position += len(data)
+        if len(self._buffer) >= self._chunk_size:
+            self.flush()
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        # pikepdf only accepts objects with seek() as output streams, a plain save never calls it.
+        raise io.UnsupportedOperation("PipeWriter is not seekable")
+
+    def flush(self) -> None:
+        if self._buffer:
+            anyio.from_thread.run(self._send_stream.send, bytes(self._buffer))
+            self._buffer.clear()
+
+async def iter_pdf(write_pdf: Callable[[PipeWriter], object]) -> AsyncIterator[bytes]:
+    """
+    Runs `write_pdf` in a worker thread and yields its output chunk by chunk.
+    The first bytes reach the client while the rest of the file is still being written.
+    
+    Args:
+        write_pdf (Callable): Writes the PDF into the given file-like object (e.g. PdfService.save_pdf).
+    """
+    send_stream, receive_stream = anyio.create_memory_object_stream(max_buffer_size=16)
+
+    async def produce():
+        async with send_stream:
+            try:
+                await anyio.to_thread.run_sync(write_pdf, PipeWriter(send_stream))
+            except anyio.BrokenResourceError:
+                # The client went away and the receiving side was closed.
+                pass
+
+    producer = asyncio.ensure_future(produce())
+    async with receive_stream:
+        async for chunk in receive_stream:
+            yield chunk
+
+    # Surface errors raised while writing.
+    await producer